@@ -4,6 +4,9 @@
 madavi.de and irceline.be.
 """
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 from matplotlib import pyplot as plt
 import pandas as pd
 
@@ -11,13 +14,23 @@ from airqdata import influencair, irceline, luftdaten, madavi, utils
 
 __version__ = "0.2"
 
+# Title of plots comparing a sensor to its nearest IRCELINE sensors
+NEAREST_IRCELINE_TITLE_PATTERN = ("{title}\n"
+                                  "{phenomenon} at {affiliation} {sid} "
+                                  "{label}\n"
+                                  "{irceline_phenomenon} at IRCELINE "
+                                  "{irceline_tsid} {irceline_station_label}\n"
+                                  "Distance: {distance:.1f} km")
+
 
 def compare_sensor_data(sensors, phenomena, start_date, end_date,
                         hourly_means=True, show_plots=True,
-                        **retrieval_kwargs):
+                        reuse_measurements=False, **retrieval_kwargs):
     """Compare the measurements of a group of sensors.
 
-    Values are plotted and returned.
+    Values are plotted and returned. Measurements that sensors already
+    hold for the period are reused unless a cache refresh or a maximum
+    cache age is requested.
 
     Args:
         sensors: sequence of sensor objects, instances of
@@ -32,27 +45,65 @@ def compare_sensor_data(sensors, phenomena, start_date, end_date,
             instead of measurements themselves
         show_plots: call show on returned plots; set to False to modify
             plots before displaying them
+        reuse_measurements: compare the measurements that sensors
+            already hold, e.g. after retrieving them concurrently,
+            without retrieving them again
         retrieval_kwargs: keyword arguments to pass to retrieve function
 
     Returns:
         Combined dataframe of sensors' measurements or their hourly
             means
         Matplotlib AxesSubplot of the combined data
-    """
-    data_pieces = []
-    combined_columns = []
-    ylabels = []
-    for sensor, column in zip(sensors, phenomena):
 
-        # Retrieve and collect data
-        sensor.get_measurements(start_date=start_date, end_date=end_date,
-                                **retrieval_kwargs)
+    Raises:
+        ValueError if no sensors are given or the numbers of sensors and
+            phenomena differ
+    """
+    if len(sensors) == 0:
+        raise ValueError("No sensors given")
+    if len(sensors) != len(phenomena):
+        raise ValueError("Provide one phenomenon per sensor")
+
+    # Parse dates once for all sensors. Retrieval still receives the date
+    # strings, which also name cache files.
+    start_timestamp = pd.Timestamp(start_date)
+    end_timestamp = pd.Timestamp(end_date)
+
+    def get_data(sensor):
+        """Retrieve and clean a sensor's measurements and return the
+        data to compare."""
+        reuse = (reuse_measurements
+                 or (not retrieval_kwargs.get("refresh_cache")
+                     and retrieval_kwargs.get("max_age") is None
+                     and sensor.measurements_cover(start_timestamp,
+                                                   end_timestamp)))
+        if not reuse:
+            sensor.get_measurements(start_date=start_date, end_date=end_date,
+                                    **retrieval_kwargs)
         sensor.clean_measurements()
         if hourly_means:
             data = sensor.get_hourly_means()
         else:
             data = sensor.measurements
-        data = data[column]
+
+        # Reused measurements may extend beyond the period
+        return data.loc[start_date:end_date]
+
+    # Retrieve data concurrently, once per sensor even if it is listed for
+    # several phenomena
+    distinct_sensors = list({id(sensor): sensor for sensor in sensors}
+                            .values())
+    with ThreadPoolExecutor(max_workers=len(distinct_sensors)) as executor:
+        sensor_data = dict(zip((id(sensor) for sensor in distinct_sensors),
+                               executor.map(get_data, distinct_sensors)))
+
+    data_pieces = []
+    combined_columns = []
+    ylabels = []
+    for sensor, column in zip(sensors, phenomena):
+
+        # Collect data
+        data = sensor_data[id(sensor)][column]
         data_pieces.append(data)
 
         # Build and collect column names for combined dataframe
@@ -65,7 +116,8 @@ def compare_sensor_data(sensors, phenomena, start_date, end_date,
         ylabels.append(ylabel)
 
     # Combine data from sensors into single dataframe
-    combined_data = pd.concat(data_pieces, axis=1, keys=combined_columns)
+    combined_data = pd.concat(data_pieces, axis=1, keys=combined_columns,
+                              copy=False)
     combined_data.columns.names = ["Phenomenon", "Sensor", "Affiliation"]
 
     # Plot data
@@ -73,7 +125,7 @@ def compare_sensor_data(sensors, phenomena, start_date, end_date,
     title = "Comparison of Sensor {}".format(aggregation_level)
     ymin = min(0, combined_data.min().min())  # Allows values below 0
     plot = combined_data.plot(title=title, ylim=(ymin, None), figsize=(16, 8))
-    plot.axes.set_ylabel("\n".join(label for label in ylabels))
+    plot.axes.set_ylabel("\n".join(ylabels))
     if show_plots:
         plt.show()
 
@@ -81,7 +133,7 @@ def compare_sensor_data(sensors, phenomena, start_date, end_date,
 
 
 def compare_nearest_irceline_sensors(sensor, start_date, end_date,
-                                     **retrieval_kwargs):
+                                     keep_figures=True, **retrieval_kwargs):
     """Compare a sensor's measurements (hourly means) to those of the
     closest IRCELINE sensor(s) that measure equivalent phenomena.
 
@@ -91,6 +143,9 @@ def compare_nearest_irceline_sensors(sensor, start_date, end_date,
             (YYYY-MM-DD) format
         end_date: end date of measurements to compare, in ISO 8601
             (YYYY-MM-DD) format
+        keep_figures: keep figures open in pyplot after showing them;
+            set to False to release their memory when comparing many
+            sensors. Returned plots remain usable, e.g. for saving.
         retrieval_kwargs: keyword arguments to pass to retrieve function
 
     Returns:
@@ -101,40 +156,55 @@ def compare_nearest_irceline_sensors(sensor, start_date, end_date,
     """
     nearest_irceline_sensors = (irceline
                                 .find_nearest_sensors(sensor,
-                                                      **retrieval_kwargs))
+                                                      **retrieval_kwargs)
+                                .to_dict(into=OrderedDict))
+    irceline_sensors = {phenomenon:
+                        irceline.Sensor(nearest_irceline_sensors[phenomenon]
+                                        ["time series id"])
+                        for phenomenon in nearest_irceline_sensors}
+
+    # Download the data of all sensors concurrently. The comparisons below
+    # then reuse them instead of retrieving them again.
+    prefetched_sensors = [sensor] + list(irceline_sensors.values())
+    with ThreadPoolExecutor(max_workers=len(prefetched_sensors)) as executor:
+        futures = [executor.submit(prefetched_sensor.get_measurements,
+                                   start_date=start_date, end_date=end_date,
+                                   **retrieval_kwargs)
+                   for prefetched_sensor in prefetched_sensors]
+        for future in futures:
+            future.result()
+
     combined_data_pieces = []
     plots = []
-    for phenomenon in nearest_irceline_sensors:
-        irceline_time_series_id = nearest_irceline_sensors.at["time series id",
-                                                              phenomenon]
-        irceline_phenomenon = nearest_irceline_sensors.at["phenomenon",
-                                                          phenomenon]
-        distance = nearest_irceline_sensors.at["distance", phenomenon]
-        irceline_sensor = irceline.Sensor(irceline_time_series_id)
-        irceline_station_label = nearest_irceline_sensors.at["station_label",
-                                                             phenomenon]
+    for phenomenon, nearest in nearest_irceline_sensors.items():
+        irceline_time_series_id = nearest["time series id"]
+        irceline_phenomenon = nearest["phenomenon"]
+        distance = nearest["distance"]
+        irceline_sensor = irceline_sensors[phenomenon]
+        irceline_station_label = nearest["station_label"]
         (combined_data_piece,
          plot) = compare_sensor_data([sensor, irceline_sensor],
                                      [phenomenon, irceline_phenomenon],
                                      start_date, end_date, show_plots=False,
+                                     reuse_measurements=True,
                                      **retrieval_kwargs)
-        title = (plot.axes.get_title()
-                 + ("\n{phenomenon} at {affiliation} {sid} {label}\n"
-                    "{irceline_phenomenon} at IRCELINE {irceline_tsid} "
-                    "{irceline_station_label}\n"
-                    "Distance: {distance:.1f} km"
-                    .format(phenomenon=phenomenon,
-                            affiliation=sensor.affiliation,
-                            sid=sensor.sensor_id,
-                            label=sensor.label,
-                            irceline_phenomenon=irceline_phenomenon,
-                            irceline_tsid=irceline_time_series_id,
-                            irceline_station_label=irceline_station_label,
-                            distance=distance)))
+        title = (NEAREST_IRCELINE_TITLE_PATTERN
+                 .format(title=plot.axes.get_title(),
+                         phenomenon=phenomenon,
+                         affiliation=sensor.affiliation,
+                         sid=sensor.sensor_id,
+                         label=sensor.label,
+                         irceline_phenomenon=irceline_phenomenon,
+                         irceline_tsid=irceline_time_series_id,
+                         irceline_station_label=irceline_station_label,
+                         distance=distance))
         plot.axes.set_title(title)
         combined_data_pieces.append(combined_data_piece)
         plots.append(plot)
-    combined_data = pd.concat(combined_data_pieces, axis=1)
+    combined_data = pd.concat(combined_data_pieces, axis=1, copy=False)
     plt.show()
+    if not keep_figures:
+        for plot in plots:
+            plt.close(plot.figure)
 
     return combined_data, plots
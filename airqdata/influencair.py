@@ -6,6 +6,7 @@ InfluencAir is a project created by Civic Lab Brussels.
 """
 
 import os
+import threading
 
 import pandas as pd
 
@@ -22,6 +23,10 @@ WEBSITE_URLS = {
     }
 MAP_URL = "http://influencair.be/map-brussels/"
 
+# Columns of the sensor sheet to use
+SENSOR_SHEET_COLUMNS = ["Chip ID", "PM Sensor ID", "Hum/Temp Sensor ID",
+                        "Label", "Address", "Floor", "Side (Street/Garden)"]
+
 
 class Metadata:
     """Sensor information as recorded on InfluencAir's Google Sheet.
@@ -35,6 +40,8 @@ class Metadata:
     """
     sensors = None
     initialized = False
+    _lock = threading.Lock()
+    _sensor_positions = {}
 
     @classmethod
     def __init__(cls, **retrieval_kwargs):
@@ -47,27 +54,62 @@ class Metadata:
         Raises:
             KeyError if sheet structure does not match listed columns
         """
+
+        # Parse only the columns to use
+        read_csv_kwargs = {"header": 1,
+                           "dtype": "object",
+                           "usecols": lambda column: (column
+                                                      in SENSOR_SHEET_COLUMNS)}
         sensor_info = retrieve(cache_file=sensor_info_cache_file,
                                url=SENSOR_SHEET_DOWNLOAD_URL,
                                label="InfluencAir sensor information",
                                read_func=pd.read_csv,
-                               read_func_kwargs={"header": 1,
-                                                 "dtype": "object"},
+                               read_func_kwargs=read_csv_kwargs,
                                call_rate_limiter=google_call_rate_limiter,
                                **retrieval_kwargs)
         try:
-            sensor_info = (sensor_info[["Chip ID", "PM Sensor ID",
-                                        "Hum/Temp Sensor ID", "Label",
-                                        "Address", "Floor",
-                                        "Side (Street/Garden)"]]
+            sensor_info = (sensor_info[SENSOR_SHEET_COLUMNS]
                            .rename(columns={"Side (Street/Garden)": "Side"}))
         except KeyError:
             raise KeyError("Could not get columns. Check if the structure or "
                            "labels of the InfluencAir sensor Google Sheet "
                            "have changed.")
+
+        # Store repeated values as categories
+        sensor_info = sensor_info.astype({"Floor": "category",
+                                          "Side": "category"})
         cls.sensors = sensor_info
+
+        # Index row positions by PM and humidity/temperature sensor IDs;
+        # the first row listing an ID is used
+        sensor_ids_by_row = sensor_info[["PM Sensor ID",
+                                         "Hum/Temp Sensor ID"]].values
+        sensor_positions = {}
+        for position, sensor_ids in enumerate(sensor_ids_by_row):
+            for sensor_id in sensor_ids:
+                if not pd.isnull(sensor_id):
+                    sensor_positions.setdefault(sensor_id, position)
+        cls._sensor_positions = sensor_positions
+
         cls.initialized = True
 
+    @classmethod
+    def ensure_initialized(cls, **retrieval_kwargs):
+        """Retrieve metadata unless this has been done already.
+
+        Safe to call from concurrent threads; metadata are retrieved
+        only once.
+
+        Args:
+            retrieval_kwargs: keyword arguments to pass to retrieve
+                function
+        """
+        if cls.initialized:
+            return
+        with cls._lock:
+            if not cls.initialized:
+                cls.__init__(**retrieval_kwargs)
+
 
 class Sensor(luftdaten.Sensor):
     """A sensor of the InfluencAir project, registered on
@@ -114,22 +156,21 @@ class Sensor(luftdaten.Sensor):
         """
 
         # Ensure that metadata can be queried
-        Metadata.initialized or Metadata(**retrieval_kwargs)
+        Metadata.ensure_initialized(**retrieval_kwargs)
 
-        id_match_rows = ((Metadata.sensors["PM Sensor ID"] == self.sensor_id)
-                         | (Metadata.sensors["Hum/Temp Sensor ID"]
-                            == self.sensor_id))
-        if sum(id_match_rows) == 0:
+        try:
+            position = Metadata._sensor_positions[self.sensor_id]
+        except KeyError:
             raise ValueError("Sensor ID {} is not listed in InfluencAir "
                              "metadata sheet".format(self.sensor_id))
-        self.influencair_metadata = (Metadata.sensors[id_match_rows].iloc[0]
+        self.influencair_metadata = (Metadata.sensors.iloc[position]
                                      .drop(labels=["PM Sensor ID",
                                                    "Hum/Temp Sensor ID"]))
         self.chip_id = self.influencair_metadata["Chip ID"]
 
         # Replace label from parent class with label from Google Sheet
         label = self.influencair_metadata["Label"]
-        if label is not pd.np.nan:
+        if not pd.isnull(label):
             self.label = label
 
     def get_luftdaten_metadata(self, **retrieval_kwargs):
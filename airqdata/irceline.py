@@ -2,15 +2,20 @@
 
 """Get and process air data from IRCELINE-run measuring stations."""
 
+import json
 import os
+import threading
+import time
 import warnings
-from itertools import chain
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import pandas as pd
-import requests
 
 from airqdata import utils
-from airqdata.utils import cache_dir, retrieve
+from airqdata.utils import (cache_dir, find_nearest, haversine, load_json,
+                            read_json, retrieve, within_bounding_box)
 
 # API
 API_DOCUMENTATION_URL = "https://geo.irceline.be/sos/static/doc/api-doc/"
@@ -24,6 +29,24 @@ API_ENDPOINTS = {
                                     "timespan={start}/{end}"),
     }
 
+# Version of the metadata tables as parsed from API responses; increase it
+# whenever their parsing changes, so that tables cached by the previous
+# version are not reused
+METADATA_FORMAT_VERSION = 1
+
+# Number of milliseconds per hour and per day, to convert timestamps to
+# hourly periods and to split time series data into days
+MILLISECONDS_PER_HOUR = 60 * 60 * 1000
+MILLISECONDS_PER_DAY = 24 * MILLISECONDS_PER_HOUR
+
+# Hours after the end of a day until its measurements are cached. IRCELINE
+# publishes measurements with a delay, so more recent days are downloaded
+# again whenever they are requested.
+DAY_CACHE_DELAY_HOURS = 6
+
+# Maximum number of time series to retrieve data of concurrently
+MAX_CONCURRENT_DOWNLOADS = 8
+
 # Other resources
 WEBSITE_URL = "http://www.irceline.be"
 VIEWER_URL = "http://viewer.irceline.be"
@@ -47,6 +70,10 @@ class Metadata:
     stations = None
     time_series = None
     initialized = False
+    _lock = threading.Lock()
+    _phenomenon_matches = {}
+    _phenomena_lower = None
+    _station_labels_lower = None
 
     @classmethod
     def __init__(cls, **retrieval_kwargs):
@@ -56,11 +83,33 @@ class Metadata:
             retrieval_kwargs: keyword arguments to pass to retrieve
                 function
         """
-        cls.get_phenomena(**retrieval_kwargs)
-        cls.get_stations(**retrieval_kwargs)
-        cls.get_time_series(**retrieval_kwargs)
+
+        # Retrieve the independent resources concurrently
+        getters = (cls.get_phenomena, cls.get_stations, cls.get_time_series)
+        with ThreadPoolExecutor(max_workers=len(getters)) as executor:
+            futures = [executor.submit(getter, **retrieval_kwargs)
+                       for getter in getters]
+            for future in futures:
+                future.result()
         cls.initialized = True
 
+    @classmethod
+    def ensure_initialized(cls, **retrieval_kwargs):
+        """Retrieve metadata unless this has been done already.
+
+        Safe to call from concurrent threads; metadata are retrieved
+        only once.
+
+        Args:
+            retrieval_kwargs: keyword arguments to pass to retrieve
+                function
+        """
+        if cls.initialized:
+            return
+        with cls._lock:
+            if not cls.initialized:
+                cls.__init__(**retrieval_kwargs)
+
     @classmethod
     def get_phenomena(cls, **retrieval_kwargs):
         """Retrieve a list of measured phenomena.
@@ -72,10 +121,10 @@ class Metadata:
         phenomena = retrieve(cache_file=phenomena_cache_file,
                              url=API_ENDPOINTS["phenomena"],
                              label="phenomenon metadata",
+                             read_func=_read_phenomena,
                              call_rate_limiter=call_rate_limiter,
+                             parsed_format=METADATA_FORMAT_VERSION,
                              **retrieval_kwargs)
-        phenomena["id"] = phenomena["id"].astype("int")
-        phenomena = phenomena.set_index("id").sort_index()
         cls.phenomena = phenomena
 
     @classmethod
@@ -86,27 +135,15 @@ class Metadata:
             retrieval_kwargs: keyword arguments to pass to retrieve
                 function
         """
-
-        # Retrieve and reshape data
         stations = retrieve(cache_file=stations_cache_file,
                             url=API_ENDPOINTS["stations"],
                             label="station metadata",
+                            read_func=_read_stations,
                             call_rate_limiter=call_rate_limiter,
+                            parsed_format=METADATA_FORMAT_VERSION,
                             **retrieval_kwargs)
-        stations = (stations
-                    .drop(columns=["geometry.type", "type"])
-                    .rename(columns={"properties.id": "id",
-                                     "properties.label": "label"})
-                    .set_index("id"))
-
-        # Split coordinates into columns
-        coords = pd.DataFrame([row
-                               for row in stations["geometry.coordinates"]],
-                              index=stations.index)
-        stations[["lat", "lon"]] = coords[[1, 0]]
-        stations.drop(columns=["geometry.coordinates"], inplace=True)
-
         cls.stations = stations
+        cls._station_labels_lower = stations["label"].str.lower()
 
     @classmethod
     def get_time_series(cls, **retrieval_kwargs):
@@ -117,54 +154,17 @@ class Metadata:
             retrieval_kwargs: keyword arguments to pass to retrieve
                 function
         """
-
-        def get_phenomenon_name(label):
-            """Extract phenomenon name from time series label."""
-            phenomenon_name_series_id = (label
-                                         .split(sep=" - ", maxsplit=1)[0])
-            phenomenon_name = phenomenon_name_series_id.rsplit(maxsplit=1)[0]
-            return phenomenon_name
-
-        # Retrieve and reshape data
         time_series = retrieve(cache_file=time_series_cache_file,
                                url=API_ENDPOINTS["time series"],
                                label="time series metadata",
+                               read_func=_read_time_series,
                                call_rate_limiter=call_rate_limiter,
+                               parsed_format=METADATA_FORMAT_VERSION,
                                **retrieval_kwargs)
-        time_series["id"] = time_series["id"].astype("int")
-        time_series = (time_series
-                       .set_index("id")
-                       .drop(columns=["station.geometry.type",
-                                      "station.type"])
-                       .rename(columns={"station.properties.id": "station_id",
-                                        "station.properties.label":
-                                            "station_label",
-                                        "uom": "unit"}))
-
-        # Extract phenomenon names from labels
-        labels = time_series["label"]
-        time_series["phenomenon"] = labels.apply(get_phenomenon_name)
-
-        # Split coordinates into columns
-        coords = pd.DataFrame([row
-                               for row
-                               in time_series["station.geometry.coordinates"]],
-                              index=time_series.index)
-        time_series[["station_lat", "station_lon"]] = coords[[1, 0]]
-
-        # Sort and drop columns
-        time_series = time_series[["label", "phenomenon", "unit",
-                                   "station_id", "station_label",
-                                   "station_lat", "station_lon"]]
-
-        # Clean unit descriptors
-        time_series["unit"] = (time_series["unit"]
-                               .str.replace("m3", "m³")
-                               .str.replace("ug", "µg"))
-        (time_series
-         .loc[time_series["phenomenon"] == "temperature", "unit"]) = "°C"
-
         cls.time_series = time_series
+        cls._phenomena_lower = (time_series["phenomenon"]
+                                .cat.categories.str.lower())
+        cls._phenomenon_matches = {}
 
     @classmethod
     def query_time_series(cls, phenomenon, lat_nearest=None, lon_nearest=None):
@@ -188,24 +188,30 @@ class Metadata:
         Raises:
             ValueError if only one of lat_nearest, lon_nearest is given
         """
-        if bool(lat_nearest is None) != bool(lon_nearest is None):
+        if (lat_nearest is None) != (lon_nearest is None):
             raise ValueError("Provide both or none of lat_nearest, "
                              "lon_nearest")
-        phenomena_lower = cls.time_series["phenomenon"].str.lower()
-        matches = phenomena_lower.str.contains(phenomenon.lower())
-        results = cls.time_series[matches].copy()
+
+        # Filter results are cached per query until time series are reloaded
+        try:
+            matching = cls._phenomenon_matches[phenomenon]
+        except KeyError:
+            # Match phenomenon categories, then select time series by
+            # category code
+            matching_codes = np.flatnonzero(cls._phenomena_lower.str
+                                            .contains(phenomenon.lower()))
+            codes = cls.time_series["phenomenon"].cat.codes.values
+            matching = cls.time_series[np.isin(codes, matching_codes)]
+            cls._phenomenon_matches[phenomenon] = matching
+
         if lat_nearest is None:
-            return results
-        if len(results) == 0:
-            results["distance"] = None
-            return results
-        results["distance"] = (results
-                               .apply(lambda row:
-                                      utils.haversine(lat_nearest, lon_nearest,
-                                                      row["station_lat"],
-                                                      row["station_lon"]),
-                                      axis=1))
-        results = results.sort_values("distance")
+            return matching.copy()  # Protect cached subset from changes
+        if len(matching) == 0:
+            return matching.assign(distance=None)
+        distances = haversine(lat_nearest, lon_nearest,
+                              matching["station_lat"].values,
+                              matching["station_lon"].values)
+        results = matching.assign(distance=distances).sort_values("distance")
         return results
 
     @classmethod
@@ -236,8 +242,9 @@ class Metadata:
         Returns:
             Matching subset of stations property
         """
-        station_labels_lower = cls.stations["label"].str.lower()
-        matching = station_labels_lower.str.contains(name.lower())
+        matching = cls._station_labels_lower.str.contains(name.lower(),
+                                                          regex=False,
+                                                          na=False)
         return cls.stations[matching]
 
     @classmethod
@@ -281,14 +288,19 @@ class Metadata:
         near={{"center":{{"type":"Point","coordinates":[{lon},
         {lat}]}},"radius":{radius}}}`
         """
-        near_stations = cls.stations.copy()
-        near_stations["distance"] = (near_stations
-                                     .apply(lambda x:
-                                            utils.haversine(lat, lon,
-                                                            x["lat"],
-                                                            x["lon"]),
-                                            axis=1))
-        near_stations = (near_stations[near_stations["distance"] <= radius]
+
+        # Calculate distances only for stations within a bounding box and
+        # select matching stations once, by position. Coordinates are
+        # stored in single precision; distances are calculated in double
+        lats = cls.stations["lat"].values.astype("float64")
+        lons = cls.stations["lon"].values.astype("float64")
+        positions = np.flatnonzero(within_bounding_box(lat, lon, radius,
+                                                       lats, lons))
+        distances = haversine(lat, lon, lats[positions], lons[positions])
+        within_radius = distances <= radius
+        near_stations = (cls.stations
+                         .iloc[positions[within_radius]]
+                         .assign(distance=distances[within_radius])
                          .sort_values("distance"))
         return near_stations
 
@@ -309,7 +321,7 @@ class Sensor(utils.BaseSensor):
         """
 
         # Ensure that metadata can be queried
-        Metadata.initialized or Metadata()
+        Metadata.ensure_initialized()
 
         super().__init__(sensor_id=time_series_id, affiliation="IRCELINE")
         self.metadata = Metadata.time_series.loc[int(time_series_id)]
@@ -336,27 +348,125 @@ class Sensor(utils.BaseSensor):
         """
 
         # Make start and end timezone aware and truncate time values
-        query_start_date = pd.to_datetime(start_date, format="%Y-%m-%d",
-                                          utc=True).normalize()
-        query_end_date = (pd.to_datetime(end_date, format="%Y-%m-%d",
-                                         utc=True).normalize()
+        query_start_date = pd.Timestamp(start_date, tz="UTC").normalize()
+        query_end_date = (pd.Timestamp(end_date, tz="UTC").normalize()
                           + pd.Timedelta(days=1))  # To include end_date data
 
         # Check validity of input and truncate end date if needed
-        today = pd.to_datetime("today", utc=True)
+        today = pd.Timestamp.now(tz="UTC").normalize()
         if query_end_date > today:
             warnings.warn("Resetting end_date to yesterday")
-            yesterday = today - pd.Timedelta(days=1)
-            end_date = yesterday.strftime("%Y-%m-%d")
             query_end_date = today  # 00:00, to include yesterday's data
         if query_start_date > query_end_date:
             raise ValueError("end_date must be greater than or equal to "
                              "start_date")
 
+        # Measurements are cached per day
+        days = pd.date_range(query_start_date,
+                             query_end_date - pd.Timedelta(days=1), freq="D")
+        day_files = OrderedDict((day, self._get_day_cache_file(day))
+                                for day in days)
+        refresh_cache = retrieval_kwargs.get("refresh_cache", False)
+        max_age = retrieval_kwargs.get("max_age")
+        expiry = -np.inf if max_age is None else time.time() - max_age
+
+        # Only one thread at a time looks up and downloads the days of a
+        # time series
+        lock = _time_series_locks.setdefault(str(self.sensor_id),
+                                             threading.Lock())
+        with lock:
+
+            # Read cached days. Days that are not cached yet, whose cache
+            # file cannot be read, is older than max_age or was written
+            # before all measurements of the day were likely published are
+            # missing, or all days if the cache is to be refreshed.
+            day_values = OrderedDict()
+            for day, day_file in day_files.items():
+                settled = (day + pd.Timedelta(days=1)
+                           + pd.Timedelta(hours=DAY_CACHE_DELAY_HOURS))
+                min_mtime = max(settled.timestamp(), expiry)
+                day_values[day] = (None if refresh_cache
+                                   else _read_day_file(day_file, min_mtime))
+            missing_days = [day for day, values in day_values.items()
+                            if values is None]
+
+            # Download each interval of consecutive missing days at once
+            intervals = []
+            for day in missing_days:
+                if (intervals
+                        and day - intervals[-1][1] == pd.Timedelta(days=1)):
+                    intervals[-1][1] = day
+                else:
+                    intervals.append([day, day])
+            for first_day, last_day in intervals:
+                downloaded = self._download_days(first_day, last_day,
+                                                 **retrieval_kwargs)
+                if downloaded is not None:
+                    day_values.update(downloaded)
+
+        # Combine the values of all days; days are missing if their
+        # download failed
+        values = [value
+                  for values_of_day in day_values.values()
+                  if values_of_day is not None
+                  for value in values_of_day]
+        if len(values) == 0:
+            return
+        timestamps = np.fromiter((value["timestamp"] for value in values),
+                                 dtype=np.int64, count=len(values))
+
+        # Single precision suffices for the measured values. Missing values
+        # become NaN.
+        measured_values = np.array([value["value"] for value in values],
+                                   dtype=np.float32)
+
+        # Hourly periods are numbered by hours since the Unix epoch, so
+        # they can be built directly from the Unix timestamps
+        hours = timestamps // MILLISECONDS_PER_HOUR
+        try:
+            index = pd.PeriodIndex.from_ordinals(hours, freq="h",
+                                                 name="Period")
+        except AttributeError:  # pandas < 2.2
+            index = pd.PeriodIndex(ordinal=hours, freq="h", name="Period")
+        data = pd.DataFrame({self.metadata["phenomenon"]: measured_values},
+                            index=index)
+
+        self.measurements = data
+
+    def _get_day_cache_file(self, day):
+        """Get the path of the file caching measurements of a day.
+
+        Args:
+            day: UTC timestamp of the start of the day
+
+        Returns:
+            Path of the cache file
+        """
+        filename = ("irceline_{time_series_id}_{date}.json"
+                    .format(time_series_id=self.sensor_id,
+                            date=day.strftime("%Y-%m-%d")))
+        return os.path.join(cache_dir, filename)
+
+    def _download_days(self, first_day, last_day, **retrieval_kwargs):
+        """Download measurements of consecutive days with one request
+        and cache them in files per day.
+
+        Args:
+            first_day: UTC timestamp of the start of the first day
+            last_day: UTC timestamp of the start of the last day
+            retrieval_kwargs: keyword arguments to pass to retrieve
+                function
+
+        Returns:
+            Ordered dictionary of lists of measurement values by day, or
+                None if the download failed
+        """
+
         # IRCELINE API takes local times. Convert start and end accordingly.
-        query_start_local = query_start_date.tz_convert("Europe/Brussels")
+        query_start_local = first_day.tz_convert("Europe/Brussels")
         query_start_local_str = query_start_local.strftime("%Y-%m-%dT%H")
-        query_end_local = query_end_date.tz_convert("Europe/Brussels")
+        query_end_local = ((last_day + pd.Timedelta(days=1))
+                           .tz_convert("Europe/Brussels"))
         query_end_local -= pd.Timedelta(1, "s")
         query_end_local_str = query_end_local.strftime("%Y-%m-%dT%H:%M:%S")
 
@@ -364,35 +474,61 @@ class Sensor(utils.BaseSensor):
                .format(time_series_id=self.sensor_id,
                        start=query_start_local_str,
                        end=query_end_local_str))
-
-        # TODO: Split response into days and cache as daily files; check cache
-        #       day by day. Find longest missing intervals to make as few
-        #       requests as possible.
         filename = ("irceline_{time_series_id}_{start_date}_{end_date}.json"
                     .format(time_series_id=self.sensor_id,
-                            start_date=start_date, end_date=end_date))
+                            start_date=first_day.strftime("%Y-%m-%d"),
+                            end_date=last_day.strftime("%Y-%m-%d")))
         filepath = os.path.join(cache_dir, filename)
 
-        # TODO: Check day by day if data are cached
-        # Retrieve and parse data
-        data = retrieve(cache_file=filepath,
-                        url=url,
-                        label="IRCELINE time series data",
-                        call_rate_limiter=call_rate_limiter,
-                        **retrieval_kwargs)
-        data = pd.DataFrame.from_dict(data.loc[0, "values"])
-        if len(data) == 0:
+        # Retrieve data, parsing the list of values directly without
+        # flattening the response
+        response = retrieve(cache_file=filepath,
+                            url=url,
+                            label="IRCELINE time series data",
+                            read_func=load_json,
+                            call_rate_limiter=call_rate_limiter,
+                            **retrieval_kwargs)
+        if response is None:  # Download failed
             return
-        data["value"] = data["value"].astype("float")
-        data = data.rename(columns={"value": self.metadata["phenomenon"]})
-
-        # Convert Unix timestamps to datetimes and then to periods for index
-        data.index = (pd.to_datetime(data["timestamp"], unit="ms", utc=True)
-                      .dt.to_period(freq="h"))
-        data.index.name = "Period"
-        data = data.drop(columns=["timestamp"])
 
-        self.measurements = data
+        # Split values into days by their Unix timestamps in milliseconds
+        first_day_timestamp = first_day.value // 10 ** 6
+        n_days = (last_day - first_day).days + 1
+        values_by_day = [[] for _ in range(n_days)]
+        for value in response["values"]:
+            day_number = ((value["timestamp"] - first_day_timestamp)
+                          // MILLISECONDS_PER_DAY)
+            if 0 <= day_number < n_days:
+                values_by_day[day_number].append(value)
+
+        # Cache days, also those without values, and remove the file of the
+        # whole interval. Recent days are not cached because IRCELINE may
+        # not have published all of their measurements yet. Day files are
+        # written to temporary files first so that readers never see a
+        # partially written day file; these are removed if writing fails.
+        cache_end = (pd.Timestamp.now(tz="UTC")
+                     - pd.Timedelta(hours=DAY_CACHE_DELAY_HOURS))
+        days = OrderedDict()
+        for day_number, day_values in enumerate(values_by_day):
+            day = first_day + pd.Timedelta(days=day_number)
+            days[day] = day_values
+            if day + pd.Timedelta(days=1) > cache_end:
+                continue
+            day_file = self._get_day_cache_file(day)
+            temp_file = "{}.{}.tmp".format(day_file, os.getpid())
+            try:
+                with open(temp_file, "w") as file:
+                    json.dump({"values": day_values}, file)
+                os.replace(temp_file, day_file)
+            except BaseException:
+                if os.path.isfile(temp_file):
+                    os.remove(temp_file)
+                raise
+        for path in filepath, filepath + utils.VALIDATORS_SUFFIX:
+            if os.path.isfile(path):
+                os.remove(path)
+
+        return days
 
     def clean_measurements(self):
         """Clean measurement data."""
@@ -408,8 +544,9 @@ class Sensor(utils.BaseSensor):
             requests.HTTPError if request failed
         """
         call_rate_limiter()
-        response = requests.get(API_ENDPOINTS["time series pattern"]
-                                .format(time_series_id=self.sensor_id))
+        response = utils.session.get(API_ENDPOINTS["time series pattern"]
+                                     .format(time_series_id=self.sensor_id),
+                                     timeout=utils.REQUEST_TIMEOUT)
         response.raise_for_status()
         time_series_data = response.json()
         last_measurement = time_series_data["lastValue"]
@@ -451,38 +588,189 @@ def find_nearest_sensors(sensor, **retrieval_kwargs):
     """
 
     # Ensure that IRCELINE metadata can be queried
-    Metadata.initialized or Metadata(**retrieval_kwargs)
+    Metadata.ensure_initialized(**retrieval_kwargs)
 
-    nearest = pd.DataFrame()
+    nearest = OrderedDict()
     for phenomenon in sensor.phenomena:
 
         # Names of comparable phenomena potentially measured by IRCELINE
-        equivalent_phenomena = (chain
-                                .from_iterable(group
-                                               for group
-                                               in utils.EQUIVALENT_PHENOMENA
-                                               if phenomenon in group))
-
-        # Collect and combine matching IRCELINE time series
-        matching_pieces = []
-        for equivalent_phenomenon in equivalent_phenomena:
-            matching_piece = Metadata.query_time_series(equivalent_phenomenon,
-                                                        lat_nearest=sensor.lat,
-                                                        lon_nearest=sensor.lon)
-            matching_pieces.append(matching_piece)
+        equivalent_phenomena = utils.PHENOMENON_EQUIVALENTS.get(phenomenon, ())
+
+        # Query matching IRCELINE time series in a single pass, with an
+        # alternation of the equivalent phenomena
+        pattern = "|".join("(?:{})".format(equivalent_phenomenon)
+                           for equivalent_phenomenon in equivalent_phenomena)
+        if not pattern:  # Would match all time series
+            continue
+        results = Metadata.query_time_series(pattern)
+        if len(results) == 0:
+            continue
+
+        # Pick nearest by position
         try:
-            results = pd.concat(matching_pieces).sort_values("distance")
-        except ValueError:  # No matching time series
+            position, distance = find_nearest(sensor.lat, sensor.lon,
+                                              results["station_lat"].values,
+                                              results["station_lon"].values)
+        except ValueError:  # No station with valid coordinates
             continue
+        nearest_result = (results
+                          .iloc[[position]]
+                          .assign(distance=distance)
+                          .reset_index()
+                          .iloc[0]
+                          .rename({"id": "time series id"}))
+        nearest[phenomenon] = nearest_result
+
+    return pd.DataFrame(nearest)
+
+
+def get_sensors(time_series_ids, start_date, end_date,
+                max_workers=MAX_CONCURRENT_DOWNLOADS, **retrieval_kwargs):
+    """Create Sensor instances for several time series and get their
+    measurement data concurrently.
+
+    Args:
+        time_series_ids: sequence of IRCELINE time series IDs as listed
+            in Metadata.time_series
+        start_date: see Sensor.get_measurements
+        end_date: see Sensor.get_measurements
+        max_workers: maximum number of time series to retrieve data of
+            concurrently
+        retrieval_kwargs: keyword arguments to pass to retrieve function
+
+    Returns:
+        List of Sensor instances, in the order of time_series_ids
+    """
+
+    # Ensure that metadata can be queried before starting threads
+    Metadata.ensure_initialized(**retrieval_kwargs)
+
+    def get_sensor(time_series_id):
+        """Create a Sensor instance and get its measurement data."""
+        sensor = Sensor(time_series_id)
+        sensor.get_measurements(start_date, end_date, **retrieval_kwargs)
+        return sensor
+
+    with ThreadPoolExecutor(max_workers) as executor:
+        return list(executor.map(get_sensor, time_series_ids))
+
+
+def _read_phenomena(file, *_args, **_kwargs):
+    """Read IRCELINE phenomenon metadata into a dataframe.
+
+    Args:
+        file: file-like object of the API's phenomena response
+        _args: positional arguments receiver; not used
+        _kwargs: keyword arguments receiver; not used
+
+    Returns:
+        Dataframe of phenomena, indexed by phenomenon ID
+    """
+    phenomena = read_json(file)
+    phenomena["id"] = phenomena["id"].astype("int")
+    phenomena = phenomena.set_index("id").sort_index()
+    return phenomena
+
+
+def _read_stations(file, *_args, **_kwargs):
+    """Read IRCELINE station metadata into a dataframe.
+
+    Args:
+        file: file-like object of the API's stations response
+        _args: positional arguments receiver; not used
+        _kwargs: keyword arguments receiver; not used
+
+    Returns:
+        Dataframe of station labels and coordinates, indexed by station
+            ID
+    """
+
+    # Pick the needed fields instead of flattening all of them
+    features = load_json(file)
+    records = [(feature["properties"]["id"],
+                feature["properties"]["label"],
+                feature["geometry"]["coordinates"][1],
+                feature["geometry"]["coordinates"][0])
+               for feature in features]
+    stations = pd.DataFrame.from_records(records,
+                                         columns=["id", "label", "lat", "lon"],
+                                         index="id")
+    stations = stations.astype({"lat": np.float32, "lon": np.float32})
+    return stations
 
-        # Pick nearest
-        first_result = (results
-                        .reset_index()
-                        .iloc[0]
-                        .rename({"id": "time series id"}))
-        nearest[phenomenon] = first_result
 
-    return nearest
+def _read_time_series(file, *_args, **_kwargs):
+    """Read IRCELINE time series metadata into a dataframe.
+
+    Args:
+        file: file-like object of the API's time series response
+        _args: positional arguments receiver; not used
+        _kwargs: keyword arguments receiver; not used
+
+    Returns:
+        Dataframe of time series labels, phenomena, units and stations,
+            indexed by time series ID
+    """
+
+    # Pick the needed fields instead of flattening all of them
+    items = load_json(file)
+    records = [(int(item["id"]),
+                item["label"],
+                item["uom"],
+                item["station"]["properties"]["id"],
+                item["station"]["properties"]["label"],
+                item["station"]["geometry"]["coordinates"][1],
+                item["station"]["geometry"]["coordinates"][0])
+               for item in items]
+    time_series = pd.DataFrame.from_records(records,
+                                            columns=["id", "label", "unit",
+                                                     "station_id",
+                                                     "station_label",
+                                                     "station_lat",
+                                                     "station_lon"],
+                                            index="id")
+
+    # Extract phenomenon names from labels
+    phenomenon_names_series_ids = (time_series["label"]
+                                   .str.split(" - ", n=1).str[0])
+    phenomena = phenomenon_names_series_ids.str.rsplit(n=1).str[0]
+    time_series.insert(1, "phenomenon", phenomena)
+
+    # Clean unit descriptors
+    time_series["unit"] = (time_series["unit"]
+                           .str.replace("m3", "m³")
+                           .str.replace("ug", "µg"))
+    time_series.loc[time_series["phenomenon"] == "temperature", "unit"] = "°C"
+
+    # Store repeated labels as categories and coordinates in single
+    # precision to save memory and speed up filtering
+    time_series = time_series.astype({"phenomenon": "category",
+                                      "unit": "category",
+                                      "station_label": "category",
+                                      "station_lat": np.float32,
+                                      "station_lon": np.float32})
+    return time_series
+
+
+def _read_day_file(day_file, min_mtime):
+    """Read the cached measurements of a day.
+
+    Args:
+        day_file: path of the file caching measurements of a day
+        min_mtime: Unix time before which the file is outdated
+
+    Returns:
+        List of measurement values, or None if the file does not exist,
+            is outdated or cannot be read, e.g. because its writing was
+            interrupted
+    """
+    try:
+        if os.path.getmtime(day_file) < min_mtime:
+            return None
+        with open(day_file, "rb") as file:
+            return load_json(file)["values"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
 
 
 # Caching
@@ -491,3 +779,7 @@ stations_cache_file = os.path.join(cache_dir, "irceline_stations.json")
 time_series_cache_file = os.path.join(cache_dir, "irceline_time_series.json")
 
 call_rate_limiter = utils.CallRateLimiter()
+
+# Locks of time series, to look up and download their days in one thread
+# at a time
+_time_series_locks = {}
@@ -3,15 +3,18 @@
 """Access resources on luftdaten.info."""
 
 import os
+import threading
 import warnings
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import pandas as pd
-import requests
 from matplotlib import pyplot as plt
-from pandas.io.json import json_normalize
 
 from airqdata import utils
-from airqdata.utils import cache_dir, retrieve
+from airqdata.utils import (cache_dir, haversine, json_normalize, load_json,
+                            retrieve)
 
 # API
 API_DOCUMENTATION_URL = "https://github.com/opendata-stuttgart/meta/wiki/APIs"
@@ -27,6 +30,27 @@ ARCHIVE_BASE_URL = "https://archive.luftdaten.info/"
 ARCHIVE_URL_PATTERN = ARCHIVE_BASE_URL + "{date}/{filename}"
 ARCHIVE_FILENAME_PATTERN = "{date}_{sensor_type}_sensor_{sensor_id}.csv"
 
+# Archive file columns to use, by sensor type, and the names of the
+# phenomena they hold
+ARCHIVE_COLUMNS = {
+    "SDS011": (("P1", "pm10"), ("P2", "pm2.5")),
+    "HPM": (("P1", "pm10"), ("P2", "pm2.5")),
+    "DHT22": (("temperature", "temperature"), ("humidity", "humidity")),
+    }
+
+# Names of phenomena that differ from the value types reported by the API
+PHENOMENON_NAMES = {"P1": "pm10", "P2": "pm2.5"}
+
+# Values that indicate errors in PM measurements
+ERROR_VALUES = (999.9, 1999.9)
+
+# Minimum number of consecutive measurements under 1 µg/m³ that indicates
+# a problem with a sensor
+DEAD_SEQUENCE_LENGTH = 5
+
+# Maximum number of daily archive files, or sensors, to retrieve concurrently
+MAX_CONCURRENT_DOWNLOADS = 8
+
 # Other resources
 WEBSITE_URL = "https://luftdaten.info"
 MAP_URL = "https://maps.luftdaten.info"
@@ -76,18 +100,21 @@ class Sensor(utils.BaseSensor):
         # Get and cache metadata and measurements of past five minutes
         filename = os.path.basename(self.metadata_url.rstrip("/")) + ".json"
         filepath = os.path.join(cache_dir, filename)
-        parsed = retrieve(cache_file=filepath,
-                          url=self.metadata_url,
-                          label=("sensor {} metadata from luftdaten.info"
-                                 .format(self.sensor_id)),
-                          call_rate_limiter=call_rate_limiter,
-                          **retrieval_kwargs)
-
+        records = retrieve(cache_file=filepath,
+                           url=self.metadata_url,
+                           label=("sensor {} metadata from luftdaten.info"
+                                  .format(self.sensor_id)),
+                           read_func=load_json,
+                           call_rate_limiter=call_rate_limiter,
+                           **retrieval_kwargs)
+
+        # Only the first record is flattened for metadata and only the last
+        # one is read for current measurements
         try:
-            metadata = (parsed
+            metadata = (json_normalize(records[0])
                         .drop(columns=["sensordatavalues", "timestamp"])
                         .iloc[0])
-        except (ValueError, AttributeError):
+        except (IndexError, TypeError, ValueError):
             warnings.warn("Sensor metadata could not be retrieved")
         else:
             metadata.name = "metadata"
@@ -100,19 +127,23 @@ class Sensor(utils.BaseSensor):
             self.label = "at " + utils.label_coordinates(self.lat, self.lon)
 
             # Extract most current measurements
-            current = parsed["sensordatavalues"].iloc[-1]
-            current = (json_normalize(current)
-                       .replace({"P1": "pm10", "P2": "pm2.5"})
-                       .set_index("value_type")["value"])
-            current = (pd.to_numeric(current)
-                       .replace([999.9, 1999.9], pd.np.nan))
+            current = OrderedDict()
+            for value in records[-1]["sensordatavalues"]:
+                phenomenon = PHENOMENON_NAMES.get(value["value_type"],
+                                                  value["value_type"])
+                measurement = float(value["value"])
+                if measurement in ERROR_VALUES:
+                    measurement = np.nan
+                current[phenomenon] = measurement
             self.current_measurements = dict(current)
-            self.phenomena = list(current.index)
+            self.phenomena = list(current)
             self.units = {phenomenon: UNITS[phenomenon]
                           for phenomenon in UNITS
                           if phenomenon in self.phenomena}
 
-    def get_measurements(self, start_date, end_date, **retrieval_kwargs):
+    def get_measurements(self, start_date, end_date,
+                         max_workers=MAX_CONCURRENT_DOWNLOADS,
+                         **retrieval_kwargs):
         """Get measurement data of the sensor in a given period.
 
         Data are read from cache if available, or downloaded from
@@ -125,18 +156,37 @@ class Sensor(utils.BaseSensor):
                 (YYYY-MM-DD) format
             end_date: last date of data to retrieve, in ISO 8601
                 (YYYY-MM-DD) format
+            max_workers: maximum number of dates to retrieve data of
+                concurrently
             retrieval_kwargs: keyword arguments to pass to retrieve
                 function
+
+        Raises:
+            ValueError if the sensor type has not been set and cannot be
+                asked for because this is not the main thread
         """
         sid = self.sensor_id
         if self.sensor_type is None:
+            if threading.current_thread() is not threading.main_thread():
+                raise ValueError("Type of sensor {} has not been set"
+                                 .format(sid))
             self.sensor_type = input("Type of sensor {} has not been set yet. "
                                      "Enter sensor type: ".format(sid))
         stype = self.sensor_type.lower()
-
-        # Get and process the data file for each date in the requested range
-        daily_data = []
-        for date in pd.date_range(start_date, end_date):
+        try:
+            columns, phenomena = zip(*ARCHIVE_COLUMNS[self.sensor_type])
+        except KeyError:
+            raise NotImplementedError("No data parsing method implemented "
+                                      "for sensor type {}"
+                                      .format(self.sensor_type))
+        read_csv_kwargs = {"sep": ";",
+                           "usecols": ("timestamp",) + columns,
+                           "dtype": {column: np.float32
+                                     for column in columns}}
+
+        def get_daily_data(date):
+            """Get the data file of a date and return its timestamps and
+            the values of the columns to use."""
             date_iso = date.strftime("%Y-%m-%d")
             filename = ARCHIVE_FILENAME_PATTERN.format(date=date_iso,
                                                        sensor_type=stype,
@@ -149,41 +199,44 @@ class Sensor(utils.BaseSensor):
                                    .format(sid, date_iso)),
                             read_func=pd.read_csv,
                             call_rate_limiter=call_rate_limiter,
-                            read_func_kwargs={"sep": ";"},
+                            read_func_kwargs=read_csv_kwargs,
                             **retrieval_kwargs)
             if data is None:
-                continue
-
-            # Parse timestamps and make them timezone aware
-            timestamps = pd.to_datetime(data["timestamp"], utc=True)
-
-            # Reformat data according to sensor type
-            data.set_index(timestamps, inplace=True)
-            if self.sensor_type in ("SDS011", "HPM"):
-                data = (data[["P1", "P2"]]
-                        .rename(columns={"P1": "pm10", "P2": "pm2.5"}))
-            elif self.sensor_type == "DHT22":
-                data = data[["temperature", "humidity"]]
-            else:
-                raise NotImplementedError("No data parsing method implemented "
-                                          "for sensor type {}"
-                                          .format(self.sensor_type))
-
-            daily_data.append(data)
-
-        # If daily data were retrieved, concatenate them to a single dataframe
-        if daily_data:
-            self.measurements = pd.concat(daily_data)
-        else:
+                return
+            timestamps = pd.to_datetime(data["timestamp"], utc=True).values
+            return timestamps, data[list(columns)].values
+
+        # Get the data of all dates in the requested range concurrently
+        dates = pd.date_range(start_date, end_date)
+        with ThreadPoolExecutor(max_workers) as executor:
+            daily_data = [data for data in executor.map(get_daily_data, dates)
+                          if data is not None]
+        if not daily_data:
             self.measurements = None
             print("No data for sensor", sid)
             return
 
-        # Remove duplicates
-        duplicates = self.measurements.index.duplicated(keep="last")
-        self.measurements = self.measurements[~duplicates]
-
-        self.measurements.sort_index(inplace=True)
+        timestamps, values = zip(*daily_data)
+        timestamps = np.concatenate(timestamps)
+        values = np.concatenate(values)
+
+        # Sort by timestamp unless days are in order already, keeping the
+        # order of duplicates, and remove duplicates, keeping the last of
+        # each
+        if not np.all(timestamps[1:] >= timestamps[:-1]):
+            order = np.argsort(timestamps, kind="mergesort")
+            timestamps = timestamps[order]
+            values = values[order]
+        last = np.append(timestamps[1:] != timestamps[:-1], True)
+        timestamps = timestamps[last]
+        values = values[last]
+
+        # Combine daily data in a single dataframe with timezone aware
+        # timestamps
+        index = (pd.DatetimeIndex(timestamps, name="timestamp")
+                 .tz_localize("UTC"))
+        self.measurements = pd.DataFrame(values, index=index,
+                                         columns=phenomena)
         self.clean_measurements()
 
     def clean_measurements(self):
@@ -196,17 +249,31 @@ class Sensor(utils.BaseSensor):
         indicate a problem.
         """
 
-        # Remove values indicating errors
-        self.measurements.replace([999.9, 1999.9], pd.np.nan, inplace=True)
+        values = self.measurements.values
 
-        # Identify middle items in sequences of at least 5 dead measurements
-        dead_5_middle = self.measurements.rolling(5, center=True).max() < 1.0
+        # Identify values indicating errors, in the precision of the data
+        invalid = np.isin(values, np.array(ERROR_VALUES, dtype=values.dtype))
 
-        # Expand to mask all items in such sequences
-        dead_5_consecutive = dead_5_middle.rolling(5, center=True).max() == 1
+        length = DEAD_SEQUENCE_LENGTH
+        if len(values) >= length:
+
+            # Identify windows of dead measurements from moving sums of dead
+            # flags, computed as differences of cumulative sums
+            dead = values < 1.0
+            padding = np.zeros((1, dead.shape[1]), dtype=int)
+            dead_counts = np.cumsum(np.concatenate([padding, dead]), axis=0)
+            dead_windows = (dead_counts[length:] - dead_counts[:-length]
+                            == length)
+
+            # Expand to mask all items in such windows, i.e. in sequences of
+            # at least DEAD_SEQUENCE_LENGTH dead measurements
+            padding = np.zeros((length, dead.shape[1]), dtype=int)
+            window_counts = np.cumsum(np.concatenate([padding, dead_windows,
+                                                      padding[1:]]), axis=0)
+            invalid |= window_counts[length:] - window_counts[:-length] > 0
 
         # Remove invalid values
-        self.measurements[dead_5_consecutive] = pd.np.nan
+        self.measurements = self.measurements.mask(invalid)
 
 
 def search_proximity(lat=50.848, lon=4.351, radius=8):
@@ -230,33 +297,34 @@ def search_proximity(lat=50.848, lon=4.351, radius=8):
     url = (API_ENDPOINTS["proximity search pattern"]
            .format(lat=lat, lon=lon, radius=radius))
     call_rate_limiter()
-    response = requests.get(url)
+    response = utils.session.get(url, timeout=utils.REQUEST_TIMEOUT)
     response.raise_for_status()
-    sensors = json_normalize(response.json())
-    if len(sensors) == 0:
+
+    # Pick the needed fields instead of flattening all of them
+    records = [(item["sensor"]["id"],
+                item["sensor"]["sensor_type"]["name"],
+                item["location"]["latitude"],
+                item["location"]["longitude"])
+               for item in response.json()]
+    if len(records) == 0:
         sensors = pd.DataFrame(columns=["sensor_type", "latitude", "longitude",
                                         "distance"])
         sensors.index.name = "sensor_id"
         return sensors
-    sensors = (sensors[["sensor.id", "sensor.sensor_type.name",
-                        "location.latitude", "location.longitude"]]
-               .rename(columns={"sensor.id": "sensor_id",
-                                "sensor.sensor_type.name": "sensor_type",
-                                "location.latitude": "latitude",
-                                "location.longitude": "longitude"}))
+    sensors = pd.DataFrame.from_records(records,
+                                        columns=["sensor_id", "sensor_type",
+                                                 "latitude", "longitude"],
+                                        index="sensor_id")
     for col in "latitude", "longitude":
         sensors[col] = pd.to_numeric(sensors[col], downcast="float")
-    sensors.set_index("sensor_id", inplace=True)
+    sensors["sensor_type"] = sensors["sensor_type"].astype("category")
 
     # Drop duplicates - sensors appear once for each measurement in past 5 mins
     sensors = sensors[~sensors.index.duplicated()]
 
     # Calculate distances from search center and sort by those distances
-    sensors["distance"] = sensors.apply(lambda x:
-                                        utils.haversine(lat, lon,
-                                                        float(x["latitude"]),
-                                                        float(x["longitude"])),
-                                        axis=1)
+    sensors["distance"] = haversine(lat, lon, sensors["latitude"].values,
+                                    sensors["longitude"].values)
     sensors.sort_values("distance", inplace=True)
 
     return sensors
@@ -264,6 +332,7 @@ def search_proximity(lat=50.848, lon=4.351, radius=8):
 
 def evaluate_near_sensors(start_date, end_date, lat=50.848, lon=4.351,
                           radius=8, sensor_type="SDS011", show=True,
+                          max_workers=MAX_CONCURRENT_DOWNLOADS,
                           **retrieval_kwargs):
     """Create Sensor instances for all sensors of sensor_type near a
     location and get their measurement data.
@@ -278,6 +347,8 @@ def evaluate_near_sensors(start_date, end_date, lat=50.848, lon=4.351,
         radius: see search_proximity
         sensor_type: sensor type label, e.g. "SDS011" or "DHT22"
         show: call plt.show; set to False to modify plots
+        max_workers: maximum number of sensors to retrieve data of
+            concurrently
         retrieval_kwargs: keyword arguments to pass to retrieve function
 
     Returns:
@@ -290,25 +361,48 @@ def evaluate_near_sensors(start_date, end_date, lat=50.848, lon=4.351,
     # Filter by sensor type
     near_sensors = near_sensors[near_sensors["sensor_type"] == sensor_type]
 
-    # Create list of Sensor instances
-    sensors = [Sensor(sensor_id, **retrieval_kwargs)
-               for sensor_id in near_sensors.index]
-
-    sensors.sort(key=lambda sensor: sensor.sensor_id)
-    hourly_means_pieces = []
-    column_keys = []
-    for sensor in sensors:
-        sensor.get_measurements(start_date, end_date, **retrieval_kwargs)
+    # Create list of Sensor instances. Sensors are retrieved concurrently,
+    # so the dates of each sensor are retrieved one after another to keep
+    # the number of concurrent downloads at max_workers.
+    def get_sensor(sensor_id):
+        """Create a Sensor instance, get its measurement data and
+        calculate their hourly means, if there are any."""
+        sensor = Sensor(sensor_id, **retrieval_kwargs)
+        if sensor.sensor_type is None:  # Metadata unavailable
+            sensor.sensor_type = sensor_type
+        sensor.get_measurements(start_date, end_date, max_workers=1,
+                                **retrieval_kwargs)
         try:
             sensor_hourly_means = sensor.get_hourly_means()
         except AttributeError:
-            continue
-        else:
+            sensor_hourly_means = None
+        return sensor, sensor_hourly_means
+
+    # Retrieve and aggregate data of several sensors concurrently
+    with ThreadPoolExecutor(max_workers) as executor:
+        results = sorted(executor.map(get_sensor, near_sensors.index),
+                         key=lambda result: result[0].sensor_id)
+
+    sensors = [sensor for sensor, _ in results]
+    hourly_means_pieces = []
+    sensor_ids = []
+    for sensor, sensor_hourly_means in results:
+        if sensor_hourly_means is not None:
             hourly_means_pieces.append(sensor_hourly_means)
-            column_keys.append(sensor.sensor_id)
-    hourly_means = pd.concat(hourly_means_pieces, axis=1, keys=column_keys)
-    hourly_means = hourly_means.swaplevel(0, 1, axis=1)
-    hourly_means.sort_index(axis=1, level=0, inplace=True)
+            sensor_ids.append(sensor.sensor_id)
+
+    # Combine into columns grouped by phenomenon, then by sensor ID
+    phenomena = sorted(set(phenomenon
+                           for piece in hourly_means_pieces
+                           for phenomenon in piece.columns))
+    columns = []
+    column_keys = []
+    for phenomenon in phenomena:
+        for sensor_id, piece in zip(sensor_ids, hourly_means_pieces):
+            if phenomenon in piece:
+                columns.append(piece[phenomenon])
+                column_keys.append((phenomenon, sensor_id))
+    hourly_means = pd.concat(columns, axis=1, keys=column_keys, copy=False)
     for measure in ("pm10", "pm2.5"):
         ax = (hourly_means.loc[:, measure]
               .plot(figsize=(16, 9), title=measure.upper(), ylim=(0, None)))
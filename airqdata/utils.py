@@ -3,19 +3,30 @@
 """Utility functions, constants and base classes."""
 
 import json
+import math
 import os
 import shutil
 import sys
+import threading
 import time
 from functools import partial
-from io import BytesIO
-from math import asin, cos, radians, sin, sqrt
 
 import matplotlib as mpl
+import numpy as np
 import pandas as pd
 import requests
 from matplotlib import pyplot as plt
-from pandas.io.json import json_normalize
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    from pandas import json_normalize
+except ImportError:  # pandas < 1.0
+    from pandas.io.json import json_normalize
+try:
+    import orjson
+except ImportError:  # Optional dependency; json is used instead
+    orjson = None
 
 # Collection of equivalent phenomenon names for comparisons between
 # sensors with different affiliations
@@ -25,6 +36,38 @@ EQUIVALENT_PHENOMENA = (
     {"temperature"},
     )
 
+# Lookup of phenomenon names to the names of all equivalent phenomena,
+# including themselves
+PHENOMENON_EQUIVALENTS = {}
+for _group in EQUIVALENT_PHENOMENA:
+    for _phenomenon in _group:
+        PHENOMENON_EQUIVALENTS.setdefault(_phenomenon, []).extend(_group)
+PHENOMENON_EQUIVALENTS = {phenomenon: tuple(equivalents)
+                          for phenomenon, equivalents
+                          in PHENOMENON_EQUIVALENTS.items()}
+
+# Mean radius of the earth in kilometers
+EARTH_RADIUS = 6371
+
+# Response headers that validate cached files, mapped to the request
+# headers that send them back to the server for conditional requests
+CONDITIONAL_HEADERS = {"ETag": "If-None-Match",
+                       "Last-Modified": "If-Modified-Since"}
+
+# Suffix of files that store the validators of cached files
+VALIDATORS_SUFFIX = ".etag"
+
+# Number of bytes to write to a cache file at a time while downloading
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Seconds to wait for a connection to a server and for its response to an
+# HTTP request
+REQUEST_TIMEOUT = (10, 30)
+
+# Minimum number of points for which haversine uses the numba kernel if
+# available; for fewer points, numpy is faster than the parallel setup
+NUMBA_MIN_POINTS = 1000
+
 
 class BaseSensor:
     """Generic sensor.
@@ -92,6 +135,30 @@ class BaseSensor:
         """Clean measurement data."""
         raise NotImplementedError("To be implemented in child classes")
 
+    def measurements_cover(self, start_date, end_date):
+        """Check whether measurement data cover a period.
+
+        Args:
+            start_date: first date of the period, in ISO 8601
+                (YYYY-MM-DD) format or as a pandas timestamp
+            end_date: last date of the period, in ISO 8601 (YYYY-MM-DD)
+                format or as a pandas timestamp
+
+        Returns:
+            True if measurements are present on every date of the
+                period, otherwise False
+        """
+        if self.measurements is None or len(self.measurements) == 0:
+            return False
+        index = self.measurements.index
+        if isinstance(index, pd.PeriodIndex):
+            index = index.to_timestamp()
+        elif index.tz is not None:
+            index = index.tz_localize(None)
+        dates = pd.date_range(pd.Timestamp(start_date).date(),
+                              pd.Timestamp(end_date).date())
+        return bool(dates.isin(index.normalize()).all())
+
     @property
     def intervals(self):
         """Histogram of times between measurements.
@@ -107,7 +174,7 @@ class BaseSensor:
         Args:
             min_count: minimum number of data points per hour required
                 to calculate means; periods failing this requirement
-                will be pd.np.nan
+                will be np.nan
 
         Returns:
             pandas dataframe of hourly means of measurements; time
@@ -115,7 +182,7 @@ class BaseSensor:
                 column per phenomenon
         """
         resampler = self.measurements.resample("h", kind="period")
-        hourly_means = resampler.sum(min_count=min_count) / resampler.count()
+        hourly_means = resampler.mean().where(resampler.count() >= min_count)
         hourly_means.index.name = "Period"
         return hourly_means
 
@@ -199,25 +266,58 @@ class CallRateLimiter:
         calls_per_second: maximum allowed rate of requests
         seconds_per_call: reciprocal of calls_per_second; time to wait
             between requests
-        seconds_between_checks: time between checks to determine whether
-            another request can be made
-        last_call_timestamp: Unix timestamp of the most recent request
+        next_call_time: earliest time of the next request in seconds on
+            the monotonic clock, which is not affected by system clock
+            updates
+        lock: lock serializing calls from concurrent threads
     """
 
     def __init__(self, calls_per_second=3):
         """Create a CallRateLimiter object."""
         self.calls_per_second = calls_per_second
         self.seconds_per_call = 1 / calls_per_second
-        self.seconds_between_checks = self.seconds_per_call / 5
-        self.last_call_timestamp = None
+        self.next_call_time = float("-inf")
+        self.lock = threading.Lock()
 
     def __call__(self):
-        """Trigger the rate limiter."""
-        if self.last_call_timestamp is not None:
-            while (time.time() - self.last_call_timestamp
-                   < self.seconds_per_call):
-                time.sleep(self.seconds_between_checks)
-        self.last_call_timestamp = time.time()
+        """Trigger the rate limiter.
+
+        Returns immediately if the previous request was long enough ago,
+        otherwise sleeps until the next request is allowed.
+        """
+        with self.lock:
+            now = time.monotonic()
+            if now < self.next_call_time:
+                time.sleep(self.next_call_time - now)
+                now = self.next_call_time
+            self.next_call_time = now + self.seconds_per_call
+
+
+def _json_loads(content):
+    """Parse JSON bytes with the json module."""
+    if sys.version_info >= (3, 6):
+        return json.loads(content)
+    return json.loads(content.decode())  # Python < 3.6 requires str
+
+
+def load_json(file, *_args, **_kwargs):
+    """Read a JSON file without flattening it.
+
+    Args:
+        file: file-like object
+        _args: positional arguments receiver; not used
+        _kwargs: keyword arguments receiver; not used
+
+    Returns:
+        Parsed JSON content, e.g. dict or list
+    """
+    content = file.read()
+    if orjson is None:
+        return _json_loads(content)
+    try:
+        return orjson.loads(content)
+    except orjson.JSONDecodeError:  # E.g. NaN, which only json accepts
+        return _json_loads(content)
 
 
 def read_json(file, *_args, **_kwargs):
@@ -232,18 +332,84 @@ def read_json(file, *_args, **_kwargs):
         Dataframe with single column level; original JSON hierarchy is
             expressed as dot notation in column names
     """
-    if sys.version_info >= (3, 6):
-        _json = json.load(file)
-    else:  # In Python < 3.6, json.load does not accept bytes stream
-        file_content_str = file.read().decode()
-        _json = json.loads(file_content_str)
-    flattened = json_normalize(_json)
+    flattened = json_normalize(load_json(file))
     return flattened
 
 
+def _read_validators(cache_file):
+    """Read the HTTP cache validators stored with a cached file.
+
+    Args:
+        cache_file: path of the cached file
+
+    Returns:
+        Dict of response header names to values, e.g. {"ETag": ...};
+            empty if no validators are stored
+    """
+    try:
+        with open(cache_file + VALIDATORS_SUFFIX) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_validators(cache_file, response_headers):
+    """Store the HTTP cache validators of a response with its cached
+    file, or remove outdated ones if the response has none.
+
+    Args:
+        cache_file: path of the cached file
+        response_headers: headers of the response that was cached
+    """
+    validators = {name: response_headers[name]
+                  for name in CONDITIONAL_HEADERS
+                  if name in response_headers}
+    validators_file = cache_file + VALIDATORS_SUFFIX
+    if validators:
+        with open(validators_file, "w") as file:
+            json.dump(validators, file)
+    elif os.path.isfile(validators_file):
+        os.remove(validators_file)
+
+
+def _get_parsed_cache_file(cache_file, parsed_format):
+    """Get the path of the pickle file caching parsed content.
+
+    Args:
+        cache_file: path of the cached file
+        parsed_format: format key of the parsed content; see retrieve
+
+    Returns:
+        Path of the pickle file
+    """
+    return "{}.parsed-{}.pkl".format(os.path.splitext(cache_file)[0],
+                                     parsed_format)
+
+
+def _mark_validated(cache_file, parsed_format=None):
+    """Update the modification time of a cached file that the server
+    confirmed to be current, and of its parsed content if that was
+    cached after the file.
+
+    Args:
+        cache_file: path of the cached file
+        parsed_format: format key of the parsed content; see retrieve
+    """
+    parsed_current = False
+    if parsed_format is not None:
+        parsed_cache_file = _get_parsed_cache_file(cache_file, parsed_format)
+        parsed_current = (os.path.isfile(parsed_cache_file)
+                          and (os.path.getmtime(parsed_cache_file)
+                               >= os.path.getmtime(cache_file)))
+    os.utime(cache_file)
+    if parsed_current:
+        os.utime(parsed_cache_file)
+
+
 def retrieve(cache_file, url, label, read_func=read_json, read_func_args=None,
              read_func_kwargs=None, refresh_cache=False,
-             call_rate_limiter=None, quiet=False):
+             call_rate_limiter=None, quiet=False, parsed_format=None,
+             max_age=None):
     """Get a resource file from cache or from a URL and parse it.
 
     Cache downloaded data.
@@ -261,78 +427,279 @@ def retrieve(cache_file, url, label, read_func=read_json, read_func_args=None,
             read_func
         read_func_kwargs: dict of keyword arguments to pass to read_func
         refresh_cache: boolean; when set to True, replace cached file
-            with a new download
+            with a new download. If the server validated the cached
+            file with an ETag or Last-Modified header, the file is
+            only downloaded again if it changed.
         call_rate_limiter: CallRateLimiter object
         quiet: do not show feedback
+        parsed_format: format key of the content as parsed by
+            read_func, e.g. a version number to change whenever
+            read_func changes its output. If given, the parsed content
+            is also cached in a pickle file named with this key next to
+            cache_file, and reused instead of parsing cache_file again
+            while that is unchanged.
+        max_age: maximum age of cache_file in seconds; an older file is
+            refreshed as with refresh_cache. None means that cached
+            files do not expire.
 
     Returns:
-        Dataframe of content retrieved from cache_file or URL
+        Content retrieved from cache_file or URL as parsed by read_func,
+            by default a dataframe
     """
     if read_func_args is None:
         read_func_args = tuple()
     if read_func_kwargs is None:
         read_func_kwargs = {}
-    if refresh_cache or not os.path.isfile(cache_file):
-
-        # Respect API call rate limit
-        if call_rate_limiter is not None:
-            call_rate_limiter()
 
-        # Download data
-        quiet or print("Downloading", label)
-        response = requests.get(url)
-
-        # Handle HTTP error codes
-        if response.status_code // 100 != 2:
-            quiet or print("No {label}: status code {status_code}, "
-                           "\"{reason}\""
-                           .format(label=label,
-                                   status_code=response.status_code,
-                                   reason=response.reason))
-            return
+    # Only one thread at a time checks and downloads a given cache file
+    with _cache_file_locks.setdefault(cache_file, threading.Lock()):
+        cached = os.path.isfile(cache_file)
+        if (cached and max_age is not None
+                and time.time() - os.path.getmtime(cache_file) > max_age):
+            refresh_cache = True
+        downloaded = False
+        if refresh_cache or not cached:
+
+            # Ask the server to send the data only if they changed since
+            # they were cached
+            validators = _read_validators(cache_file) if cached else {}
+            headers = {CONDITIONAL_HEADERS[name]: value
+                       for name, value in validators.items()}
+
+            # Respect API call rate limit
+            if call_rate_limiter is not None:
+                call_rate_limiter()
+
+            # Download data
+            quiet or print("Downloading", label)
+            response = session.get(url, headers=headers,
+                                   timeout=REQUEST_TIMEOUT, stream=True)
+            try:
+                if response.status_code // 100 == 2:
+
+                    # Stream downloaded data into the cache and store their
+                    # validators. The data are written to a temporary file
+                    # first so that readers never see a partially written
+                    # cache file. It is removed if the download fails.
+                    temp_file = "{}.{}.tmp".format(cache_file, os.getpid())
+                    chunks = response.iter_content(DOWNLOAD_CHUNK_SIZE)
+                    try:
+                        with open(temp_file, "wb") as file:
+                            for chunk in chunks:
+                                file.write(chunk)
+                        os.replace(temp_file, cache_file)
+                    except BaseException:
+                        if os.path.isfile(temp_file):
+                            os.remove(temp_file)
+                        raise
+                    _write_validators(cache_file, response.headers)
+                    downloaded = True
+
+                # 304 means that the cached file is unchanged
+                elif response.status_code == 304:
+                    _mark_validated(cache_file, parsed_format)
+
+                # Handle HTTP error codes
+                else:
+                    quiet or print("No {label}: status code {status_code}, "
+                                   "\"{reason}\""
+                                   .format(label=label,
+                                           status_code=response.status_code,
+                                           reason=response.reason))
+                    return
+            finally:
+                response.close()
+
+    if parsed_format is not None:
+        parsed_cache_file = _get_parsed_cache_file(cache_file, parsed_format)
+    if not downloaded:
+        quiet or print("Using cached", label)
 
-        # Cache downloaded data
-        with open(cache_file, "wb") as file:
-            file.write(response.content)
+        # Reuse parsed content if it was cached after the file
+        if (parsed_format is not None and os.path.isfile(parsed_cache_file)
+                and (os.path.getmtime(parsed_cache_file)
+                     >= os.path.getmtime(cache_file))):
+            try:
+                return pd.read_pickle(parsed_cache_file)
+            except Exception:  # E.g. pickled by other pandas version
+                pass
+
+    # Parse cached file directly, without copying it into a buffer
+    with open(cache_file, "rb") as file:
+        parsed = read_func(file, *read_func_args, **read_func_kwargs)
+
+    # Cache parsed content, replacing any previous version at once
+    if parsed_format is not None:
+        temp_file = "{}.{}.{}.tmp".format(parsed_cache_file, os.getpid(),
+                                          threading.get_ident())
+        try:
+            pd.to_pickle(parsed, temp_file)
+            os.replace(temp_file, parsed_cache_file)
+        except BaseException:
+            if os.path.isfile(temp_file):
+                os.remove(temp_file)
+            raise
 
-        # Load downloaded data into a buffer
-        buffer = BytesIO(response.content)
+    return parsed
 
-    else:
 
-        # Load cached file into a buffer
-        quiet or print("Using cached", label)
-        with open(cache_file, "rb") as file:
-            buffer = BytesIO(file.read())
+def _haversine_loop(lat, lon, lats, lons):
+    """Haversine from one point to many points in a single pass without
+    intermediate arrays, to be compiled by numba. See haversine for
+    arguments.
+    """
+    lat = math.radians(lat)
+    lon = math.radians(lon)
+    cos_lat = math.cos(lat)
+    distances = np.empty(lats.shape[0])
+    for i in numba.prange(lats.shape[0]):
+        lat_i = math.radians(lats[i])
+        d_lat = lat_i - lat
+        d_lon = math.radians(lons[i]) - lon
+        a = (math.sin(d_lat / 2) ** 2
+             + cos_lat * math.cos(lat_i) * math.sin(d_lon / 2) ** 2)
+        distances[i] = 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+    return distances
+
+
+def _get_haversine_kernel():
+    """Import numba and compile the haversine kernel on first use, so
+    that importing this module does not pay for it.
 
-    return read_func(buffer, *read_func_args, **read_func_kwargs)
+    Returns:
+        Compiled kernel, or None if numba is not installed
+    """
+    global numba, _haversine_kernel
+    with _haversine_kernel_lock:
+        if _haversine_kernel is None:
+            try:
+                import numba
+            except ImportError:  # Optional dependency; numpy is used
+                _haversine_kernel = False
+            else:
+                _haversine_kernel = numba.njit(parallel=True, fastmath=True,
+                                               cache=True)(_haversine_loop)
+    return _haversine_kernel or None
 
 
 def haversine(lat1, lon1, lat2, lon2):
     """Calculate the great circle distance between two points on earth.
 
+    Coordinates can be scalars or array-likes of matching shape; arrays
+    are processed in a single vectorized pass. Distances from one point
+    to many points are calculated by a compiled kernel if numba is
+    installed.
+
     Args:
         lat1, lon1, lat2, lon2: coordinates of point 1 and point 2 in
             decimal degrees
 
     Returns:
-        Distance in kilometers
+        Distance in kilometers; float for scalar input, numpy array
+            for array input
     """
+    if (np.ndim(lat1) == 0 and np.ndim(lon1) == 0
+            and np.ndim(lat2) == 1 and np.size(lat2) >= NUMBA_MIN_POINTS):
+        kernel = _get_haversine_kernel()
+        if kernel is not None:
+            return kernel(float(lat1), float(lon1),
+                          np.asarray(lat2, dtype="float64"),
+                          np.asarray(lon2, dtype="float64"))
 
     # Convert decimal degrees to radians
-    lat1, lon1, lat2, lon2 = (radians(val) for val in (lat1, lon1, lat2, lon2))
+    lat1, lon1, lat2, lon2 = (np.radians(val)
+                              for val in (lat1, lon1, lat2, lon2))
 
     # Haversine formula
     d_lat = lat2 - lat1
     d_lon = lon2 - lon1
-    a = sin(d_lat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(d_lon / 2) ** 2
-    c = 2 * asin(sqrt(a))
-    radius = 6371  # Radius of earth in kilometers
-    distance = c * radius
+    a = (np.sin(d_lat / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin(d_lon / 2) ** 2)
+    c = 2 * np.arcsin(np.sqrt(a))
+    distance = c * EARTH_RADIUS
 
     return distance
 
 
+def within_bounding_box(lat, lon, radius, lats, lons):
+    """Check which points lie within the latitude/longitude bounding box
+    of a circle on earth.
+
+    The check is cheaper than calculating distances and can be used to
+    discard points before calculating them. All points within the circle
+    are within the bounding box, but not vice versa.
+
+    Args:
+        lat: latitude of the center of the circle in decimal degrees
+        lon: longitude of the center of the circle in decimal degrees
+        radius: radius of the circle in kilometers
+        lats: array-like of latitudes of the points in decimal degrees
+        lons: array-like of longitudes of the points in decimal degrees
+
+    Returns:
+        Boolean numpy array; True for points within the bounding box
+    """
+    lats = np.asarray(lats)
+    lons = np.asarray(lons)
+    angle = radius / EARTH_RADIUS  # In radians
+    lat_delta = math.degrees(angle)
+    within = np.abs(lats - lat) <= lat_delta
+
+    # Longitudes are not restricted if the circle contains a pole
+    if angle + math.radians(abs(lat)) < math.pi / 2:
+        lon_delta = math.degrees(math.asin(math.sin(angle)
+                                           / math.cos(math.radians(lat))))
+        d_lon = (lons - lon + 180) % 360 - 180  # Wrap around antimeridian
+        within &= np.abs(d_lon) <= lon_delta
+    return within
+
+
+def find_nearest(lat, lon, lats, lons, candidates=8):
+    """Find the point nearest to a location.
+
+    Points are first ranked by an equirectangular approximation of their
+    distances, which is cheap to calculate and accurate over short
+    distances. Exact distances are calculated for the best-ranked
+    candidates only.
+
+    Args:
+        lat: latitude of the location in decimal degrees
+        lon: longitude of the location in decimal degrees
+        lats: array-like of latitudes of the points in decimal degrees
+        lons: array-like of longitudes of the points in decimal degrees
+        candidates: number of best-ranked points to calculate exact
+            distances for
+
+    Returns:
+        Position of the nearest point in lats and lons; points with
+            missing coordinates are ignored
+        Distance to the nearest point in kilometers
+
+    Raises:
+        ValueError if no points with valid coordinates are given
+    """
+    lats = np.asarray(lats, dtype="float64")
+    lons = np.asarray(lons, dtype="float64")
+
+    # Consider only points with valid coordinates, by position
+    valid = np.flatnonzero(np.isfinite(lats) & np.isfinite(lons))
+    if len(valid) == 0:
+        raise ValueError("No points with valid coordinates given")
+    if len(valid) > candidates:
+        valid_lats = lats[valid]
+        d_lon = (lons[valid] - lon + 180) % 360 - 180  # Wrap at antimeridian
+        x = np.radians(d_lon) * np.cos(np.radians((valid_lats + lat) / 2))
+        y = np.radians(valid_lats - lat)
+        approximations = x ** 2 + y ** 2
+        positions = valid[np.argpartition(approximations,
+                                          candidates)[:candidates]]
+    else:
+        positions = valid
+    distances = haversine(lat, lon, lats[positions], lons[positions])
+    nearest = distances.argmin()
+    return int(positions[nearest]), float(distances[nearest])
+
+
 def label_coordinates(lat, lon):
     """Combine a set of numeric coordinates into a string with
     hemisphere indicators.
@@ -368,6 +735,25 @@ cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "airqdata")
 if not os.path.isdir(cache_dir):
     os.makedirs(cache_dir)
 
+# Locks of cache files by path, serializing their downloads
+_cache_file_locks = {}
+
+# Optional numba module and compiled haversine kernel, both loaded on first
+# use by _get_haversine_kernel; the kernel is False if numba is missing
+numba = None
+_haversine_kernel = None
+_haversine_kernel_lock = threading.Lock()
+
+# HTTP session reusing connections across requests, retrying requests that
+# fail due to temporary server problems. The last response is returned if
+# all retries fail.
+session = requests.Session()
+_retry = Retry(total=3, backoff_factor=0.3, status_forcelist=(502, 503, 504),
+               raise_on_status=False)
+for _prefix in ("http://", "https://"):
+    session.mount(_prefix, HTTPAdapter(pool_connections=4, pool_maxsize=16,
+                                       max_retries=_retry))
+
 # Variant of pandas DataFrame.describe method showing an interval that contains
 # 98% of the data, instead of the default interquartile range
 describe = partial(pd.DataFrame.describe, percentiles=[0.01, 0.99])
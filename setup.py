@@ -40,8 +40,13 @@ setup(name="airqdata",
       packages=find_packages(),
       install_requires=[
           "matplotlib>=2",
+          "numpy>=1.13",
           "pandas>=0.22",
           "requests>=2.10",
       ],
+      extras_require={
+          "numba": ["numba"],
+          "orjson": ["orjson"],
+      },
       python_requires=">=3.5",
       )
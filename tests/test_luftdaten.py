@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+"""Test the cleaning of luftdaten.info measurements on synthetic data."""
+
+import os
+import sys
+import unittest
+
+import numpy as np
+import pandas as pd
+
+here = os.path.dirname(__file__)
+project_dir = os.path.normpath(os.path.join(here, os.path.pardir))
+sys.path.append(project_dir)
+
+from airqdata import luftdaten  # noqa: E402
+
+# Shorthands for dead, valid and missing values
+DEAD = 0.5
+VALID = 5.0
+NAN = np.nan
+
+
+def clean(columns, dtype="float64"):
+    """Clean synthetic measurements with Sensor.clean_measurements.
+
+    Args:
+        columns: dict of lists of values by column name
+        dtype: data type of the measurements
+
+    Returns:
+        Dataframe of cleaned measurements
+    """
+    sensor = luftdaten.Sensor.__new__(luftdaten.Sensor)
+    sensor.measurements = pd.DataFrame(columns, dtype=dtype)
+    sensor.clean_measurements()
+    return sensor.measurements
+
+
+class TestCleanMeasurements(unittest.TestCase):
+
+    def assert_cleaned(self, values, expected, dtype="float64"):
+        """Check cleaning of a single column of values."""
+        cleaned = clean({"pm10": values}, dtype=dtype)["pm10"].values
+        np.testing.assert_array_equal(cleaned,
+                                      np.array(expected, dtype=dtype))
+
+    def test_sequence_of_four_dead_values_is_kept(self):
+        values = [VALID] + [DEAD] * 4 + [VALID]
+        self.assert_cleaned(values, values)
+
+    def test_sequence_of_five_dead_values_is_removed(self):
+        values = [VALID] + [DEAD] * 5 + [VALID]
+        self.assert_cleaned(values, [VALID] + [NAN] * 5 + [VALID])
+
+    def test_longer_sequence_is_removed_entirely(self):
+        values = [VALID] * 2 + [DEAD] * 7 + [VALID] * 2
+        self.assert_cleaned(values, [VALID] * 2 + [NAN] * 7 + [VALID] * 2)
+
+    def test_sequences_at_edges_are_removed_entirely(self):
+        values = [DEAD] * 5 + [VALID] * 3 + [DEAD] * 6
+        self.assert_cleaned(values, [NAN] * 5 + [VALID] * 3 + [NAN] * 6)
+
+    def test_missing_value_interrupts_sequence(self):
+        values = [DEAD] * 2 + [NAN] + [DEAD] * 4 + [VALID]
+        self.assert_cleaned(values, values)
+
+    def test_error_value_interrupts_sequence_and_is_removed(self):
+        values = [DEAD] * 3 + [999.9] + [DEAD] * 3 + [1999.9, VALID]
+        expected = [DEAD] * 3 + [NAN] + [DEAD] * 3 + [NAN, VALID]
+        self.assert_cleaned(values, expected)
+
+    def test_error_values_are_removed_in_single_precision(self):
+        values = [VALID, 999.9, 1999.9, VALID, VALID, VALID]
+        expected = [VALID, NAN, NAN, VALID, VALID, VALID]
+        self.assert_cleaned(values, expected, dtype="float32")
+
+    def test_error_values_are_removed_from_short_data(self):
+        self.assert_cleaned([DEAD, 999.9, DEAD], [DEAD, NAN, DEAD])
+
+    def test_columns_are_cleaned_independently(self):
+        cleaned = clean({"pm10": [VALID] + [DEAD] * 5 + [VALID],
+                         "pm2.5": [DEAD] * 4 + [VALID] + [DEAD] * 2})
+        np.testing.assert_array_equal(cleaned["pm10"].values,
+                                      [VALID] + [NAN] * 5 + [VALID])
+        np.testing.assert_array_equal(cleaned["pm2.5"].values,
+                                      [DEAD] * 4 + [VALID] + [DEAD] * 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+"""Test geographic helper functions on synthetic data."""
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+here = os.path.dirname(__file__)
+project_dir = os.path.normpath(os.path.join(here, os.path.pardir))
+sys.path.append(project_dir)
+
+from airqdata.utils import (find_nearest, haversine,  # noqa: E402
+                            within_bounding_box)
+
+
+def random_points(n, lat, lon, spread, seed=0):
+    """Generate random points around a location.
+
+    Args:
+        n: number of points
+        lat: latitude of the location in decimal degrees
+        lon: longitude of the location in decimal degrees
+        spread: maximum difference of coordinates from the location in
+            decimal degrees
+        seed: seed of the random number generator
+
+    Returns:
+        Numpy arrays of latitudes and longitudes; longitudes are wrapped
+            into [-180, 180)
+    """
+    rng = np.random.RandomState(seed)
+    lats = np.clip(lat + rng.uniform(-spread, spread, n), -90, 90)
+    lons = (lon + rng.uniform(-spread, spread, n) + 180) % 360 - 180
+    return lats, lons
+
+
+class TestWithinBoundingBox(unittest.TestCase):
+
+    def assert_contains_circle(self, lat, lon, radius, lats, lons):
+        """Check that all points within the circle are in the box."""
+        within_circle = haversine(lat, lon, lats, lons) <= radius
+        within_box = within_bounding_box(lat, lon, radius, lats, lons)
+        self.assertTrue(within_circle.any())
+        self.assertFalse((within_circle & ~within_box).any())
+        return within_box
+
+    def test_contains_circle(self):
+        lats, lons = random_points(10000, 50.848, 4.351, 1)
+        within_box = self.assert_contains_circle(50.848, 4.351, 30,
+                                                 lats, lons)
+        self.assertFalse(within_box.all())
+
+    def test_excludes_distant_points(self):
+        within_box = within_bounding_box(50.848, 4.351, 10,
+                                         [50.848, 50.848, 52.0],
+                                         [4.351, 6.0, 4.351])
+        np.testing.assert_array_equal(within_box, [True, False, False])
+
+    def test_wraps_around_antimeridian(self):
+        lats, lons = random_points(10000, -17.0, 179.9, 1)
+        self.assert_contains_circle(-17.0, 179.9, 50, lats, lons)
+        within_box = within_bounding_box(-17.0, 179.9, 50,
+                                         [-17.0, -17.0], [-179.9, 179.0])
+        np.testing.assert_array_equal(within_box, [True, False])
+
+    def test_does_not_restrict_longitudes_around_pole(self):
+        within_box = within_bounding_box(89.9, 0, 50, [89.9, 89.9, 88.0],
+                                         [0, 180, 0])
+        np.testing.assert_array_equal(within_box, [True, True, False])
+
+
+class TestFindNearest(unittest.TestCase):
+
+    def assert_nearest(self, lat, lon, lats, lons, **kwargs):
+        """Check the result against distances to all points."""
+        distances = haversine(lat, lon, lats, lons)
+        position, distance = find_nearest(lat, lon, lats, lons, **kwargs)
+        self.assertEqual(position, int(distances.argmin()))
+        self.assertAlmostEqual(distance, float(distances.min()))
+
+    def test_many_points(self):
+        for seed in range(20):
+            lats, lons = random_points(500, 50.5, 4.5, 1.5, seed=seed)
+            self.assert_nearest(50.848, 4.351, lats, lons)
+
+    def test_fewer_points_than_candidates(self):
+        lats, lons = random_points(5, 50.5, 4.5, 1.5)
+        self.assert_nearest(50.848, 4.351, lats, lons, candidates=8)
+
+    def test_single_candidate(self):
+        lats, lons = random_points(100, 50.5, 4.5, 0.5)
+        self.assert_nearest(50.848, 4.351, lats, lons, candidates=1)
+
+    def test_wraps_around_antimeridian(self):
+        position, distance = find_nearest(-17.0, 179.9, [-17.0, -17.0],
+                                          [178.0, -179.9], candidates=1)
+        self.assertEqual(position, 1)
+        self.assertLess(distance, 25)
+
+    def test_ignores_missing_coordinates(self):
+        lats, lons = random_points(500, 50.5, 4.5, 1.5)
+        lats[::3] = np.nan
+        lons[1::3] = np.nan
+        valid = np.flatnonzero(np.isfinite(lats) & np.isfinite(lons))
+        distances = haversine(50.848, 4.351, lats[valid], lons[valid])
+        for candidates in 8, 1000:
+            position, distance = find_nearest(50.848, 4.351, lats, lons,
+                                              candidates=candidates)
+            self.assertEqual(position, int(valid[distances.argmin()]))
+            self.assertAlmostEqual(distance, float(distances.min()))
+
+    def test_no_points(self):
+        with self.assertRaises(ValueError):
+            find_nearest(50.848, 4.351, [], [])
+
+    def test_no_valid_points(self):
+        with self.assertRaises(ValueError):
+            find_nearest(50.848, 4.351, [np.nan, 50.0], [4.0, np.nan])
+
+
+if __name__ == "__main__":
+    unittest.main()